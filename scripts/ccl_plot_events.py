@@ -33,18 +33,36 @@
 # SYNOPSIS
 # ========
 #
-# **ccl_plot_events.py** *FILE.TSV*
+# **ccl_plot_events.py** [**--tmin** *T*] [**--tmax** *T*] [**--no-cache**] *FILE.TSV*...
 #
 # DESCRIPTION
 # ===========
 #
-# The `ccl_plot_events` script accepts a single parameter indicating
-# a file containing profiling info exported using the
-# @ref CCL_PROFILER "profiler module".
+# The `ccl_plot_events` script accepts a parameter indicating a file
+# containing profiling info exported using the
+# @ref CCL_PROFILER "profiler module". If several files are given, they
+# are plotted in parallel, and the figure of each *FILE.TSV* is saved to
+# *FILE.TSV.png* instead of being shown.
 #
-# This script requires a [Python](https://www.python.org/) installation,
-# and depends on the [Matplotlib](http://matplotlib.org/) and
-# [NumPy](http://www.numpy.org/) libraries.
+# The following options are available:
+#
+# * **--tmin** *T*: Only plot events which end at or after instant *T*.
+# * **--tmax** *T*: Only plot events which start at or before instant *T*.
+# * **--no-cache**: Do not read or write the *FILE.TSV.npz* cache file.
+# * **--version**: Output version information and exit.
+#
+# The loaded profiling info is cached in a *FILE.TSV.npz* file, which is
+# reused in later runs as long as the size and modification time of
+# *FILE.TSV* do not change.
+#
+# This script requires a [Python](https://www.python.org/) 3.7 or later
+# installation, and depends on the [Matplotlib](http://matplotlib.org/)
+# (3.5 or later) and [NumPy](http://www.numpy.org/) libraries. If the
+# [PyArrow](https://arrow.apache.org/docs/python/) or
+# [pandas](https://pandas.pydata.org/) libraries are available, they are
+# used for faster loading of the profiling info. If the
+# [Numba](https://numba.pydata.org/) library is available, it is used to
+# speed up plotting of very large numbers of events.
 #
 # AUTHOR
 # ======
@@ -68,85 +86,314 @@
 # There is NO WARRANTY, to the extent permitted by law.
 #
 
-import sys
-import os.path
+import argparse
+import importlib
+import os
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 import numpy
-import pylab
+import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+from matplotlib.collections import PathCollection
+from matplotlib.path import Path
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# Above this number of events, rectangles are built with a JIT-compiled
+# kernel, if Numba is available; below it, loading the cached kernel takes
+# longer than the NumPy build (measured crossover at about 3-4M events)
+JIT_THRESHOLD = 4000000
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def build_rects(t_start, t_end, q_idx, verts):
+        """Fill the vertices of the rectangles representing the events in a
+        single parallel pass."""
+        for i in prange(len(t_start)):
+            x0 = t_start[i]
+            x1 = t_end[i]
+            y0 = q_idx[i] - 0.4
+            y1 = y0 + 0.8
+            verts[i, 0, 0] = x0
+            verts[i, 0, 1] = y0
+            verts[i, 1, 0] = x1
+            verts[i, 1, 1] = y0
+            verts[i, 2, 0] = x1
+            verts[i, 2, 1] = y1
+            verts[i, 3, 0] = x0
+            verts[i, 3, 1] = y1
+
+def optional_import(*names):
+    """Import the given modules and return the first one, or None if any of
+    them is not available."""
+    try:
+        modules = [importlib.import_module(name) for name in names]
+    except ImportError:
+        return None
+    return modules[0]
+
+def arrow_to_numpy(chunks, dtype):
+    """Convert the given PyArrow arrays of a primitive type to a single NumPy
+    array. The data buffers of arrays without nulls are read directly, since
+    PyArrow's to_numpy() imports pandas."""
+    dtype = numpy.dtype(dtype)
+    return numpy.concatenate([numpy.empty(0, dtype)] + [
+        numpy.frombuffer(chunk.buffers()[1], dtype=dtype, count=len(chunk),
+            offset=chunk.offset * dtype.itemsize) if chunk.null_count == 0
+        else chunk.to_numpy(zero_copy_only=False).astype(dtype)
+        for chunk in chunks])
+
+def sorted_codes(column):
+    """Given a dictionary-encoded PyArrow column, return its sorted distinct
+    values and the index of each row in them."""
+    column = column.combine_chunks()
+    values = numpy.array(column.dictionary.to_pylist())
+    order = numpy.argsort(values)
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+    return values[order].tolist(), rank[arrow_to_numpy([column.indices], numpy.int32)]
+
+def read_cache(cache, stat):
+    """Return the profiling info in the given cache file as a dictionary of
+    arrays, or None if the file does not exist, cannot be read, or was not
+    created from a file with the given stat (size and modification time)."""
+    if not os.path.isfile(cache):
+        return None
+    try:
+        with numpy.load(cache) as npz:
+            if 'src_size' not in npz.files or 'src_mtime_ns' not in npz.files \
+                    or npz['src_size'] != stat.st_size \
+                    or npz['src_mtime_ns'] != stat.st_mtime_ns:
+                return None
+            return {key: npz[key] for key in npz.files}
+    except (OSError, EOFError, ValueError, zipfile.BadZipFile):
+        # The cache is optional, e.g. it may not be readable or be corrupt
+        return None
+
+def plot_events(filename, args, output=None):
+    """Plot the events in the given file with profiling info, using the
+    options in args. The figure is saved to output, if given, or shown
+    otherwise."""
+
+    # Load profiling info in given file, reusing the info cached by a previous
+    # run if the file has the same size and modification time as back then
+    cache = filename + '.npz'
+    stat = os.stat(filename)
+    pdat = None if args.no_cache else read_cache(cache, stat)
+    cached = pdat is not None
+    if not cached:
+        # Only import the optional loaders when the file has to be parsed,
+        # and pandas only if PyArrow is not available
+        pyarrow = optional_import('pyarrow', 'pyarrow.csv')
+        pandas = optional_import('pandas') if pyarrow is None else None
+    if cached:
+        queues = pdat['queues'].tolist()
+        q_idx = pdat['q_idx']
+        uniq_evts = pdat['uniq_evts'].tolist()
+        evt_idx = pdat['evt_idx']
+        t_start = pdat['t_start']
+        t_end = pdat['t_end']
+    elif pyarrow is not None:
+        # Use the multithreaded PyArrow CSV reader, dictionary-encoding queues
+        # and event names, whose codes give the queue and event name index of
+        # each event
+        pdat = pyarrow.csv.read_csv(filename,
+            read_options=pyarrow.csv.ReadOptions(
+                column_names=['queue','t_start','t_end','event']),
+            parse_options=pyarrow.csv.ParseOptions(delimiter='\t'),
+            convert_options=pyarrow.csv.ConvertOptions(column_types={
+                'queue':pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+                't_start':pyarrow.float64(),
+                't_end':pyarrow.float64(),
+                'event':pyarrow.dictionary(pyarrow.int32(), pyarrow.string())}))
+        queues, q_idx = sorted_codes(pdat.column('queue'))
+        uniq_evts, evt_idx = sorted_codes(pdat.column('event'))
+        t_start = arrow_to_numpy(pdat.column('t_start').chunks, numpy.float64)
+        t_end = arrow_to_numpy(pdat.column('t_end').chunks, numpy.float64)
+    elif pandas is not None:
+        # Use the pandas C parser, reading queues and event names as categories,
+        # whose codes are the queue and event name index of each event
+        pdat = pandas.read_csv(filename, sep='\t', header=None,
+            names=['queue','t_start','t_end','event'],
+            dtype={'queue':'category', 't_start':numpy.float64,
+                't_end':numpy.float64, 'event':'category'},
+            engine='c')
+        queues = pdat['queue'].cat.categories.tolist()
+        q_idx = pdat['queue'].cat.codes.to_numpy()
+        uniq_evts = pdat['event'].cat.categories.tolist()
+        evt_idx = pdat['event'].cat.codes.to_numpy()
+        t_start = pdat['t_start'].to_numpy()
+        t_end = pdat['t_end'].to_numpy()
+    else:
+        # Let the column types be inferred, so that queue and event names are
+        # read with the width of the longest one and are never truncated
+        pdat = numpy.genfromtxt(filename, delimiter='\t', dtype=None,
+            encoding='utf-8', names=('queue','t_start','t_end','event'))
+        # Get queues and event names, and the respective index of each event
+        queues, q_idx = numpy.unique(pdat['queue'], return_inverse=True)
+        queues = queues.tolist()
+        uniq_evts, evt_idx = numpy.unique(pdat['event'], return_inverse=True)
+        uniq_evts = uniq_evts.tolist()
+        t_start = pdat['t_start'].astype(numpy.float64)
+        t_end = pdat['t_end'].astype(numpy.float64)
+
+    # Cache the loaded info for later runs; write it to a uniquely named
+    # temporary file first, so that neither an interrupted run nor concurrent
+    # runs leave a truncated cache behind
+    if not cached and not args.no_cache:
+        try:
+            with tempfile.NamedTemporaryFile(
+                    dir=os.path.dirname(os.path.abspath(cache)),
+                    prefix=os.path.basename(cache) + '.', suffix='.tmp',
+                    delete=False) as f:
+                try:
+                    numpy.savez(f, queues=queues, q_idx=q_idx,
+                        uniq_evts=uniq_evts, evt_idx=evt_idx,
+                        t_start=t_start, t_end=t_end,
+                        src_size=stat.st_size, src_mtime_ns=stat.st_mtime_ns)
+                    # Temporary files are only accessible by their owner, so
+                    # give the cache the usual permissions of new files
+                    umask = os.umask(0)
+                    os.umask(umask)
+                    os.chmod(f.name, 0o666 & ~umask)
+                except:
+                    os.remove(f.name)
+                    raise
+            os.replace(f.name, cache)
+        except OSError:
+            # The cache is optional, e.g. the folder may not be writable
+            pass
+
+    # Determine number of queues
+    num_queues = len(queues)
+
+    # Determine time window to plot (by default, the whole profiling info)
+    tmin = t_start.min() if args.tmin is None else args.tmin
+    tmax = t_end.max() if args.tmax is None else args.tmax
+    if tmin >= tmax:
+        raise ValueError("Empty time window [" + str(tmin) + ", "
+            + str(tmax) + "] for file '" + filename + "'")
+
+    # Discard events outside of the time window
+    visible = (t_end >= tmin) & (t_start <= tmax)
+    t_start, t_end, q_idx, evt_idx = (
+        a[visible] for a in (t_start, t_end, q_idx, evt_idx))
+
+    # Create matplotlib figure
+    fig = plt.figure()
+    # Set relative dimensions of plotting area
+    ax = plt.axes([0.1, 0.1, 0.71, 0.8])
+    # Set a vertical grid
+    plt.grid(True, axis='x')
+    # Set axis absolute dimensions of plotting area (depends on profiling info)
+    ax.set_xlim(tmin, tmax)
+    ax.set_ylim(-0.5, num_queues - 0.5)
+    # Set ticks to queue names
+    plt.yticks(range(num_queues), queues, size='small')
+
+    # Determine number of event names
+    num_uniq_evts = len(uniq_evts)
+    # Associate a different color with each event name
+    cmap = matplotlib.colormaps['nipy_spectral']
+    color_table = cmap(numpy.linspace(0, 1, num_uniq_evts, endpoint=False))
+
+    # Create legend handles (one color patch for each event name)
+    handles = [patches.Patch(edgecolor='black', facecolor=color, linestyle='solid', fill=True)
+        for color in color_table]
+
+    # Build the vertices of the rectangles representing the events
+    verts = numpy.empty((len(t_start), 4, 2))
+    if njit is not None and len(t_start) > JIT_THRESHOLD:
+        build_rects(t_start, t_end, q_idx, verts)
+    else:
+        # Determine the vertical extent of each event
+        y0 = q_idx - 0.4
+        y1 = y0 + 0.8
+
+        verts[:, 0, 0] = t_start
+        verts[:, 0, 1] = y0
+        verts[:, 1, 0] = t_end
+        verts[:, 1, 1] = y0
+        verts[:, 2, 0] = t_end
+        verts[:, 2, 1] = y1
+        verts[:, 3, 0] = t_start
+        verts[:, 3, 1] = y1
+
+    # Join the rectangles of the events with the same name in a single compound
+    # path, since they all have the same color; rectangles are grouped by event
+    # name with one sort, keeping their original order within each group
+    order = numpy.argsort(evt_idx, kind='stable')
+    bounds = numpy.cumsum(numpy.bincount(evt_idx, minlength=num_uniq_evts))[:-1]
+    paths = [Path.make_compound_path_from_polys(group)
+        for group in numpy.split(verts[order], bounds)]
+
+    # Plot all events at once; snapping is forced since it is otherwise disabled
+    # for paths with many vertices, and events would not be aligned to pixels.
+    # Events are rasterized, so that vector output does not contain (and
+    # viewers do not have to render) a polygon for each event
+    ax.add_collection(PathCollection(paths, facecolors=color_table, edgecolors='none', antialiased=False, snap=True, rasterized=True), autolim=False)
+
+    # Add legend
+    plt.legend(handles, uniq_evts, borderaxespad=0, bbox_to_anchor=(1.02, 1), loc=2, prop={'size':'x-small'})
+
+    # Label axes
+    plt.ylabel('Queues')
+    plt.xlabel('Time')
+
+    # Show figure, or save it if an output file was given
+    if output is None:
+        plt.show()
+    else:
+        fig.savefig(output)
+        plt.close(fig)
+
+if __name__ == '__main__':
+    # Check command-line arguments
+    parser = argparse.ArgumentParser(description='Plots a Gantt-like chart of '
+        'OpenCL events using the profiling info exported using the cf4ocl '
+        'profiler module.')
+    parser.add_argument('files', metavar='FILE.TSV', nargs='+',
+        help='files containing exported profiling info')
+    parser.add_argument('--tmin', type=float,
+        help='only plot events which end at or after this instant')
+    parser.add_argument('--tmax', type=float,
+        help='only plot events which start at or before this instant')
+    parser.add_argument('--no-cache', action='store_true',
+        help='do not read or write the FILE.TSV.npz cache file')
+    parser.add_argument('--version', action='version',
+        version='ccl_plot_events.py v2.0.0')
+    args = parser.parse_args()
+    if args.tmin is not None and args.tmax is not None \
+            and args.tmin >= args.tmax:
+        parser.error('--tmin must be lower than --tmax')
+    for filename in args.files:
+        if not os.path.isfile(filename):
+            print("File not found: '" + filename + "'\n")
+            exit(-2)
+
+    # Discard files given more than once (e.g. through globs or symlinks),
+    # so that no two processes plot the same file
+    files = []
+    seen = set()
+    for filename in args.files:
+        if os.path.realpath(filename) not in seen:
+            seen.add(os.path.realpath(filename))
+            files.append(filename)
 
-# Check command-line arguments
-if len(sys.argv) < 2:
-    print 'Usage: ' + sys.argv[0] + ' <file.tsv>\n'
-    exit(-1)
-elif sys.argv[1] == '--version':
-    print 'ccl_plot_events.py v2.0.0\n'
-    exit(0)
-elif not os.path.isfile(sys.argv[1]):
-    print "File not found: '" + sys.argv[1] + "'\n"
-    exit(-2)
-
-
-# Load profiling info in file given as first cli argument
-pdat = numpy.genfromtxt(sys.argv[1], delimiter='\t', dtype=None, names=('queue','t_start','t_end','event'))
-
-# Get queues
-queues = numpy.unique(pdat['queue']).tolist()
-# Determine number of queues
-num_queues = len(queues)
-
-# Create matplotlib figure
-plt.figure()
-# Set relative dimensions of plotting area
-ax = plt.axes([0.1, 0.1, 0.71, 0.8])
-# Set a vertical grid
-plt.grid(True, axis='x')
-# Set axis absolute dimensions of plotting area (depends on profiling info)
-plt.axis([min(pdat['t_start']), max(pdat['t_end']), -0.5, num_queues - 0.5])
-# Set ticks to queue names
-plt.yticks(range(num_queues), queues, size='small')
-
-# Determine event names
-uniq_evts = numpy.unique(pdat['event']).tolist()
-# Determine number of event names
-num_uniq_evts = len(uniq_evts)
-# Associate a different color with each event name
-cmap = pylab.cm.get_cmap('spectral')
-uniq_colors = [x*cmap.N/num_uniq_evts for x in range(num_uniq_evts)]
-
-# Create legend handles (one for each event name)
-handles = []
-for uniq_evt in uniq_evts:
-    # Determine index of current event name
-    uei = uniq_evts.index(uniq_evt)
-    # Get color associated with current event name
-    color = cmap(uniq_colors[uei])
-    # Create a color patch for the legend of the current event name
-    ptch = patches.Patch(edgecolor='black', facecolor=color, linestyle='solid', fill=True)
-    # Add patch to legend handles
-    handles.append(ptch)
-
-# Plot events
-for event in pdat:
-    # Determine plotting locations for current event
-    x = event['t_start']
-    y = queues.index(event['queue']) - 0.4
-    width = event['t_end'] - event['t_start']
-    # Determine index of event name of which current event is an instance of
-    uei = uniq_evts.index(event['event'])
-    # Determine the color for current event (which is the same for the
-    # associated event name)
-    color = cmap(uniq_colors[uei])
-    # Plot event
-    rect = patches.Rectangle((x, y), width, 0.8, edgecolor='none', facecolor=color, fill=True)
-    plt.gca().add_patch(rect)
-
-# Add legend
-plt.legend(handles, uniq_evts, borderaxespad=0, bbox_to_anchor=(1.02, 1), loc=2, prop={'size':'x-small'})
-
-# Label axes
-plt.ylabel('Queues')
-plt.xlabel('Time')
-
-# Show figure
-plt.show()
+    try:
+        if len(files) == 1:
+            plot_events(files[0], args)
+        else:
+            # Plot each file in a separate process with a non-interactive
+            # backend, saving the figures instead of showing them
+            with ProcessPoolExecutor(initializer=matplotlib.use,
+                    initargs=('Agg',)) as executor:
+                list(executor.map(plot_events, files,
+                    [args] * len(files), [f + '.png' for f in files]))
+    except ValueError as e:
+        # The time window does not overlap the profiling info
+        parser.error(str(e))